@@ -1,8 +1,37 @@
-import json
+import asyncio
+import logging
+import logging.handlers
+import queue
 import random
-import socket
-import threading
-from typing import Dict, List
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import msgspec
+
+logger = logging.getLogger(__name__)
+
+_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_MAX_MESSAGE = 1024 * 1024  # Longest line a client may send, in bytes
+
+class Action(msgspec.Struct):
+    action: Optional[str] = None
+    name: msgspec.Raw = msgspec.Raw()  # Left undecoded, turns only need to know it was sent
+
+class Identify(msgspec.Struct):
+    name: str
+    game_version: str
+
+class Join(msgspec.Struct):
+    code: str
+
+_encoder = msgspec.json.Encoder()
+_action_decoder = msgspec.json.Decoder(Action)
+_identify_decoder = msgspec.json.Decoder(Identify)
+_join_decoder = msgspec.json.Decoder(Join)
+_turn_decoder = msgspec.json.Decoder(dict)
+
+def _frame(d: dict) -> bytes:
+    return _encoder.encode(d) + b'\n'
 
 
 class LobbyDoesntExistException(Exception):
@@ -23,183 +52,238 @@ class Lobby:
     def __init__(self, code: str, version: str) -> None:
         self.code = code
         self.version = version
-        self.clients: Dict[str, "ClientThread"] = {}
         self.max_players = 2
+        # Slot i holds the connected client for names[i], or None while they're away
+        self.slots: List[Optional["Client"]] = [None] * self.max_players
+        self.names: List[Optional[str]] = [None] * self.max_players
+        self.live_count: int = 0
+
+    async def message(self, d: dict):
+        await self.send_bytes(_frame(d))
 
-    def message(self, d: dict, exclude=None):
+    async def send_bytes(self, *buffers: bytes, exclude=None):
         if exclude is None:
-            exclude = []
+            exclude = set()
 
-        for client_name, client_thread in self.clients.items():
-            if client_thread not in exclude:
-                client_thread.send_json(d)
+        recipients = [c for c in self.slots if c is not None and c not in exclude]
+        for client in recipients:
+            if len(buffers) == 1:
+                client.writer.write(buffers[0])
+            else:
+                # Scatter-gather, so the buffers are never joined (a single sendmsg on 3.12+)
+                client.writer.writelines(buffers)
+        results = await asyncio.gather(*(c.writer.drain() for c in recipients), return_exceptions=True)
+        for client, result in zip(recipients, results):
+            if isinstance(result, Exception):
+                # Broken connection, closing it lets handle_client run the disconnect
+                client.writer.close()
 
-    def disconnect(self, name: str):
-        self.clients[name] = None
+    async def disconnect(self, name: str):
+        if name in self.names:
+            i = self.names.index(name)
+            if self.slots[i] is not None:
+                self.live_count -= 1
+            self.slots[i] = None
         # TODO: Maybe allow reconnects to bricked lobbies? Otherwise, eh
-        if all([c is None for c in self.clients.values()]):
+        if self.live_count == 0:
             del self.lobbies[self.code]
-            print(f"Deleting lobby {self.code}")
+            logger.info("Deleting lobby %s", self.code)
             # And then we should be garbage collected?
-        for client_name, client_thread in self.clients.items():
-            if client_thread is not None:
-                client_thread.send_json({"action": "disconnect", "name": name})
+        await self._broadcast_event("disconnect", name)
 
-    def connect(self, client_thread):
-        self.clients[client_thread.name] = client_thread
-        self.message({"action": "connect", "name": client_thread.name})
+    async def connect(self, client: "Client"):
+        # Reconnecting players get their old slot back, new ones take the first free slot
+        i = self.names.index(client.name if client.name in self.names else None)
+        if self.slots[i] is None:
+            self.live_count += 1
+        self.names[i] = client.name
+        self.slots[i] = client
+        await self._broadcast_event("connect", client.name)
+
+    async def _broadcast_event(self, action: str, name: str):
+        await self.message({"action": action, "name": name})
 
     @classmethod
     def generate_code(cls):
+        length = 4
+        attempts = 0
         while True:
-            code = "".join([random.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(4)])
+            code = "".join(random.choices(_ALPHABET, k=length))
             if code not in cls.lobbies:
                 return code
+            # Codes of this length are getting crowded, so use longer ones
+            attempts += 1
+            if attempts % 8 == 0:
+                length += 1
 
     @classmethod
-    def create(cls, client_thread: "ClientThread", version: str) -> "Lobby":
+    async def create(cls, client: "Client", version: str) -> "Lobby":
         code = cls.generate_code()
         lobby = cls(code, version)
         cls.lobbies[code] = lobby
-        lobby.connect(client_thread)
-        lobby.message({"action": "code", "code": code})
+        await lobby.connect(client)
+        await lobby.message({"action": "code", "code": code})
         return lobby
 
     @classmethod
-    def join(cls, client_thread: "ClientThread", code: str, version: str) -> "Lobby":
+    async def join(cls, client: "Client", code: str, version: str) -> "Lobby":
         if code not in cls.lobbies:
             raise LobbyDoesntExistException()
         lobby = cls.lobbies[code]
         if lobby.version != version:
             raise MismatchedVersionException(lobby.version)
-        if client_thread.name in lobby.clients and lobby.clients[client_thread.name] is not None:
-            raise AlreadyConnectedException()
-        if client_thread.name not in lobby.clients and len(lobby.clients) >= lobby.max_players:
+        if client.name in lobby.names:
+            if lobby.slots[lobby.names.index(client.name)] is not None:
+                raise AlreadyConnectedException()
+        elif None not in lobby.names:
             raise LobbyFullException()
-        lobby.connect(client_thread)
+        await lobby.connect(client)
         return lobby
 
-class NewlineReceiver:
-    def __init__(self, client_socket: socket.socket) -> None:
-        self.buffer = b''
-        self.client_socket = client_socket
+@dataclass(eq=False)
+class Client:
+    writer: asyncio.StreamWriter
+    address: tuple
 
-    def __call__(self):
-        delimiter = b'\n'
-        while delimiter not in self.buffer:
-            try:
-                data = self.client_socket.recv(1024)
-            except ConnectionResetError:
-                return None
-            if not data:  # Client connection closed
-                return None
-            self.buffer += data
-        line, sep, self.buffer = self.buffer.partition(delimiter)
-        return line.decode('utf-8')
-
-class ClientThread(threading.Thread):
-    def __init__(self, client_socket: socket.socket, address) -> None:
-        super().__init__()
-        self.client_socket = client_socket
-        self.address = address
-
-        self.recv = NewlineReceiver(self.client_socket)
-
-        self.name: str = None
-        self.game_version: str = None
-        self.lobby: Lobby = None
-
-    def send_json(self, d: dict):
-        self.send_string(json.dumps(d))
-
-    def send_string(self, message: str):
-        self.client_socket.send(f"{message}\n".encode('utf-8'))
-
-    def handle_message(self, d: dict):
-        print("message", d)
-        if "action" not in d:
-            self.send_json({"action": "error", "type": "unknown_action"})
-            return
-        match d["action"]:
-            case "identify":
-                self.action_identify(d)
-            case "create":
-                self.action_create(d)
-            case "join":
-                self.action_join(d)
-            case "turn":
-                self.action_turn(d)
-            case _:
-                self.send_json({"action": "error", "type": "unknown_action"})
-
-    def action_identify(self, d: dict):
-        self.name = d["name"]
-        self.game_version = d["game_version"]
-        self.send_json({"action": "message", "message": f"Hi {self.name} using {self.game_version}"})
-
-    def action_create(self, d: dict):
+    name: Optional[str] = None
+    game_version: Optional[str] = None
+    lobby: Optional[Lobby] = None
+
+    async def send_json(self, d: dict):
+        await self.send_bytes(_frame(d))
+
+    async def send_bytes(self, payload: bytes):
+        self.writer.write(payload)
+        await self.writer.drain()
+
+    async def handle_message(self, message: bytes):
+        logger.debug("message %r", message)
+        # Only the action is decoded here, each handler decodes the fields it needs
+        try:
+            peek = _action_decoder.decode(message)
+            handler = _HANDLERS.get(peek.action)
+            if handler is None:
+                await self.send_json({"action": "error", "type": "unknown_action"})
+                return
+            await handler(self, message, peek)
+        except msgspec.DecodeError as e:
+            await self.send_json({"action": "error", "type": "invalid_message", "message": str(e)})
+
+    async def action_identify(self, message: bytes, peek: Action):
+        msg = _identify_decoder.decode(message)
+        self.name = msg.name
+        self.game_version = msg.game_version
+        await self.send_json({"action": "message", "message": f"Hi {self.name} using {self.game_version}"})
+
+    async def action_create(self, message: bytes, peek: Action):
         if self.name is None:
-            self.send_json({"action": "error", "type": "unidentified"})
+            await self.send_json({"action": "error", "type": "unidentified"})
         else:
-            self.lobby = Lobby.create(self, self.game_version)
+            self.lobby = await Lobby.create(self, self.game_version)
 
-    def action_join(self, d: dict):
+    async def action_join(self, message: bytes, peek: Action):
         if self.name is None:
-            self.send_json({"action": "error", "type": "unidentified"})
+            await self.send_json({"action": "error", "type": "unidentified"})
         else:
+            msg = _join_decoder.decode(message)
             try:
-                self.lobby = Lobby.join(self, d["code"], self.game_version)
+                self.lobby = await Lobby.join(self, msg.code, self.game_version)
             except LobbyDoesntExistException:
-                self.send_json({"action": "error", "type": "lobby_doesnt_exist"})
+                await self.send_json({"action": "error", "type": "lobby_doesnt_exist"})
             except MismatchedVersionException as e:
-                self.send_json({"action": "error", "type": "mismatched_version", "message": str(e)})
+                await self.send_json({"action": "error", "type": "mismatched_version", "message": str(e)})
             except AlreadyConnectedException:
-                self.send_json({"action": "error", "type": "already_connected"})
+                await self.send_json({"action": "error", "type": "already_connected"})
             except LobbyFullException:
-                self.send_json({"action": "error", "type": "lobby_full"})
+                await self.send_json({"action": "error", "type": "lobby_full"})
 
-    def action_turn(self, d: dict):
+    async def action_turn(self, message: bytes, peek: Action):
         if self.name is None:
-            self.send_json({"action": "error", "type": "unidentified"})
+            await self.send_json({"action": "error", "type": "unidentified"})
         elif self.lobby is None:
-            self.send_json({"action": "error", "type": "not_in_lobby"})
+            await self.send_json({"action": "error", "type": "not_in_lobby"})
         else:
-            self.lobby.message({**d, "name": self.name}, exclude=[self])
+            # Decoding the action skipped the other fields without checking their encoding
+            try:
+                message.decode('utf-8')
+            except UnicodeDecodeError as e:
+                await self.send_json({"action": "error", "type": "invalid_message", "message": str(e)})
+                return
+            if peek.name:
+                # Rare, so re-encode rather than relay a duplicate "name" key
+                d = _turn_decoder.decode(message)
+                d["name"] = self.name
+                await self.lobby.send_bytes(_frame(d), exclude={self})
+                return
+            # Relay the sender's bytes untouched apart from appending their name.
+            # handle_message already checked this is a JSON object followed only by whitespace,
+            # so the last "}" closes it
+            body = memoryview(message)[:message.rindex(b'}')]
+            name_field = b',"name":' + _encoder.encode(self.name) + b'}\n'
+            await self.lobby.send_bytes(body, name_field, exclude={self})
 
-    def run(self):
-        while True:
-            message = self.recv()
-            if message is None:
-                break
-            d = json.loads(message)
-            self.handle_message(d)
-        # Handle disconnect logic
-        if self.lobby is not None:
-            self.lobby.disconnect(self.name)
-            print(f"Client {str(self)} disconnected")
-        self.client_socket.close()
-    
     def __str__(self):
         return f"Client(name={self.name}, lobby={None if self.lobby is None else self.lobby.code})"
 
+_HANDLERS = {
+    "identify": Client.action_identify,
+    "create": Client.action_create,
+    "join": Client.action_join,
+    "turn": Client.action_turn,
+}
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    client = Client(writer, writer.get_extra_info("peername"))
+    try:
+        while True:
+            try:
+                message = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError:  # Client connection closed
+                break
+            except asyncio.LimitOverrunError:
+                await client.send_json({"action": "error", "type": "message_too_long"})
+                break
+            await client.handle_message(message)
+    except OSError:  # Connection dropped while reading or replying (reset, broken pipe, timeout)
+        pass
+    finally:
+        # Handle disconnect logic, even if the connection broke mid-message
+        if client.lobby is not None:
+            await client.lobby.disconnect(client.name)
+            logger.info("Client %s disconnected", client)
+        writer.close()
+
+async def amain(args):
+    server = await asyncio.start_server(
+        handle_client, args.host, args.port, backlog=args.backlog, limit=_MAX_MESSAGE
+    )
+    logger.info("Listening on %s", ", ".join(str(s.getsockname()) for s in server.sockets))
+
+    async with server:
+        await server.serve_forever()
+
 def main(args):
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((args.host, args.port))
-    server_socket.listen(16)
-    print(f"Listening on {server_socket}")
-
-    while True:
-        client_socket, address = server_socket.accept()
-        client_thread = ClientThread(client_socket, address)
-        client_thread.daemon = True
-        client_thread.start()
-    
+    # Records are still formatted on the event loop (QueueHandler.prepare), but writing them out
+    # happens on the listener's thread, so a slow stderr never blocks the event loop
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=args.log_level, handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    try:
+        asyncio.run(amain(args))
+    finally:
+        listener.stop()
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", default=9001, type=int)
     parser.add_argument("--host", default="localhost")  # 0.0.0.0 for external
+    parser.add_argument("--backlog", default=1024, type=int)
+    parser.add_argument(
+        "--log-level", default="INFO", type=str.upper, choices=["DEBUG", "INFO", "WARNING", "ERROR"]
+    )  # DEBUG to log every message
     args = parser.parse_args()
 
     main(args)
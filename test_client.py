@@ -1,10 +1,34 @@
 import socket
-import json
 import threading
-from server import NewlineReceiver
+
+import msgspec
+
+_encoder = msgspec.json.Encoder()
+_decoder = msgspec.json.Decoder()
+
+class NewlineReceiver:
+    def __init__(self, client_socket: socket.socket) -> None:
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.client_socket = client_socket
+
+    def __call__(self):
+        while (idx := self.buffer.find(b'\n', self.scan_pos)) == -1:
+            self.scan_pos = len(self.buffer)
+            try:
+                data = self.client_socket.recv(4096)
+            except ConnectionResetError:
+                return None
+            if not data:  # Client connection closed
+                return None
+            self.buffer.extend(data)
+        line = bytes(self.buffer[:idx])
+        del self.buffer[:idx + 1]
+        self.scan_pos = 0
+        return line
 
 def send(client_socket, d):
-    client_socket.send(f"{json.dumps(d)}\n".encode('utf-8'))
+    client_socket.sendall(_encoder.encode(d) + b'\n')
 
 class TestClient(threading.Thread):
     def __init__(self, client_socket) -> None:
@@ -20,12 +44,13 @@ class TestClient(threading.Thread):
             message = self.recv()
             if message is None:
                 break
-            d = json.loads(message)
+            d = _decoder.decode(message)
             self.handle_message(d)
 
 def main(args):
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((args.server, args.port))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     send(client_socket, {"action": "identify", "name": args.name, "game_version": args.game_version})
     if args.create:
         send(client_socket, {"action": "create"})
@@ -39,7 +64,7 @@ def main(args):
         try:
             json_string = input("> ")
             if json_string:
-                send(client_socket, json.loads(json_string))
+                send(client_socket, _decoder.decode(json_string))
         except Exception as e:
             print(e)
             continue